@@ -21,7 +21,7 @@ def parse_args(base_parser: ArgumentParser, args: List[str], namespace: Namespac
     parser.add_argument('--beta1', default=0.9, type=float)
     parser.add_argument('--beta2', default=0.95, type=float)
     parser.add_argument('--scheduler', default='cos', choices=['linear', 'cos', 'none'])
-    parser.add_argument('--opt', default='adamw', choices=['adamw', 'sgd'])
+    parser.add_argument('--opt', default='adamw', choices=['adamw', 'adamw8bit', 'flashadamw', 'sgd'])
     parser.add_argument('--eval_freq', default=200, type=int)  # in iterations
     parser.add_argument('--results_base_folder', default="./exps", type=str)
     parser.add_argument('--grad_clip', default=1.0, type=float)  # default value is 1.0 in NanoGPT
@@ -32,6 +32,7 @@ def parse_args(base_parser: ArgumentParser, args: List[str], namespace: Namespac
                         #          'three_multi_specific', 'three_multi_mixed',
                         #          'github_wiki_specific', 'github_wiki_mixed',
                         #          'fed_cc_news'])
+    parser.add_argument('--no_data_on_device', action='store_true')  # if true then training tokens stay on the host
     parser.add_argument('--vocab_size', default=50304, type=int)
     # Model params
     parser.add_argument('--model', default='lora', choices=['lora'])
@@ -45,6 +46,8 @@ def parse_args(base_parser: ArgumentParser, args: List[str], namespace: Namespac
     parser.add_argument('--dtype', default=torch.bfloat16, type=torch.dtype)
     parser.add_argument('--bias', default=False, type=bool)
     parser.add_argument('--no_compile', action='store_true')  # if true then model is not compiled
+    # if true then all the clients run a single forward/backward over their concatenated batches (more memory)
+    parser.add_argument('--batched_clients', action='store_true')
     # Distributed args
     parser.add_argument('--distributed_backend', default=None, type=str, required=False,
                         choices=distributed.registered_backends())  # distributed backend type
@@ -1,7 +1,7 @@
 from argparse import Namespace
-from typing import List, Any
+from typing import List, Any, Callable
 
-from torch import nn
+from torch import nn, Tensor
 
 
 class DistributedBackend(object):
@@ -30,5 +30,8 @@ class DistributedBackend(object):
     def get_world_size(self) -> int:
         raise NotImplementedError
 
+    def average_tensors_async(self, tensors: List[Tensor]) -> Callable[[], None]:
+        raise NotImplementedError
+
     def finalize(self):
         pass
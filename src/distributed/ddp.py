@@ -2,10 +2,10 @@ import math
 import os
 from argparse import Namespace
 from contextlib import contextmanager
-from typing import List
+from typing import List, Callable
 
-from torch import nn
-from torch.distributed import init_process_group, destroy_process_group, get_world_size
+from torch import nn, Tensor
+from torch.distributed import init_process_group, destroy_process_group, get_world_size, all_reduce
 from torch.nn.parallel import DistributedDataParallel as DDP
 
 from .backend import DistributedBackend
@@ -55,5 +55,16 @@ class DataParallelDistributedBackend(DistributedBackend):
     def get_world_size(self) -> int:
         return get_world_size()
 
+    def average_tensors_async(self, tensors: List[Tensor]) -> Callable[[], None]:
+        """ Launches an in-place all-reduce for each (contiguous) tensor, the returned function waits for them """
+        works = [all_reduce(tensor, async_op=True) for tensor in tensors]
+
+        def wait() -> None:
+            for tensor, work in zip(tensors, works):
+                work.wait()
+                tensor.div_(self.get_world_size())
+
+        return wait
+
     def finalize(self) -> None:
         destroy_process_group()
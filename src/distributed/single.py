@@ -1,8 +1,8 @@
 from argparse import Namespace
 from contextlib import nullcontext
-from typing import List
+from typing import List, Callable
 
-from torch import nn
+from torch import nn, Tensor
 
 from .backend import DistributedBackend
 
@@ -29,3 +29,6 @@ class SingleNodeBackend(DistributedBackend):
 
     def translate_model_parameter_name_for_node(self, parameter_name: str) -> List[str]:
         return [parameter_name]
+
+    def average_tensors_async(self, tensors: List[Tensor]) -> Callable[[], None]:
+        return lambda: None
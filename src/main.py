@@ -1,5 +1,4 @@
 import argparse
-import copy
 import inspect
 import json
 import os
@@ -9,14 +8,20 @@ from argparse import Namespace
 
 import numpy as np
 import torch
+import torch._inductor.config
 import wandb
 
 import config
 import distributed
 from data.utils import get_dataset
+from models.lora import get_lora_parameters
 from models.utils import get_model
 from optim.lora import train_lora
 
+_ADAMW_HAS_FUSED = 'fused' in inspect.signature(torch.optim.AdamW).parameters
+_FUSED_ADAMW_MAX_TENSORS = 128
+_TORCH_VERSION = tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2])
+
 
 def get_args() -> Namespace:
     parser = argparse.ArgumentParser(allow_abbrev=False)
@@ -46,6 +51,11 @@ def get_exp_name(args: Namespace) -> str:
 def main(args: Namespace) -> None:
     torch.backends.cuda.matmul.allow_tf32 = True  # allows us to make sure we're able to use tensor float32 during training
     torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True  # batch size and sequence length are fixed, pick the fastest kernels once
+    # dynamo still traces every client, but the clients share the same architecture so inductor's code generation
+    # for the graphs of the first one is reused by the others; the cache is inductor's per-user one, shared by runs
+    if hasattr(torch._inductor.config, 'fx_graph_cache'):
+        torch._inductor.config.fx_graph_cache = True
 
     distributed_backend = distributed.make_backend_from_args(args)
     args = distributed_backend.get_adjusted_args_for_process(args)
@@ -54,6 +64,19 @@ def main(args: Namespace) -> None:
     device_type = 'cuda' if 'cuda' in str(args.device) else 'cpu'
     if device_type == 'cuda':
         torch.cuda.set_device(args.device)
+    if args.opt == 'adamw8bit' and device_type != 'cuda':
+        # the 8-bit optimizer states of bitsandbytes are only implemented with CUDA kernels
+        raise ValueError(f"--opt adamw8bit requires a CUDA device, got '{args.device}'.")
+    if args.opt == 'flashadamw' and _TORCH_VERSION < (2, 6):
+        # fail before loading anything rather than on the import of flashoptim
+        raise ValueError(f"--opt flashadamw requires PyTorch >= 2.6 (flashoptim), got {torch.__version__}.")
+    if args.opt == 'flashadamw' and device_type != 'cuda':
+        # bf16 LoRA weights rely on the bf16 autocast of the forward, which is only used on CUDA
+        raise ValueError(f"--opt flashadamw requires a CUDA device, got '{args.device}'.")
+
+    if args.batched_clients and args.distributed_backend is not None:
+        # the gradients of the batched pass reach the clients outside of their DDP wrappers, they would not be synced
+        raise ValueError(f"--batched_clients is not supported with the '{args.distributed_backend}' backend.")
 
     torch.manual_seed(args.seed)
     random.seed(args.seed)
@@ -63,55 +86,74 @@ def main(args: Namespace) -> None:
 
     data_path = get_dataset_from_args(args)
     
-    clients = []
-
+    models = []
+    group_specs = []
     for i in range(args.num_clients):
         model = get_model(args).to(args.device)
+        if args.opt == 'flashadamw':
+            # LoRA weights are held in bf16, the optimizer takes care of the stochastic rounding of the updates
+            for p in get_lora_parameters(model).values():
+                if p.requires_grad:
+                    p.data = p.data.to(torch.bfloat16)
         model = distributed_backend.transform_model(model)
 
-        group_specs = distributed_backend.get_raw_model(model).get_parameter_group_specs()
+        client_group_specs = distributed_backend.get_raw_model(model).get_parameter_group_specs()
         param_name_mapping = {p_name: p for p_name, p in model.named_parameters()}
-        optimized_params_cnt = 0
-        for g in group_specs:
+        for g in client_group_specs:
             params = []
             for p_name in g['params']:
                 translated_p_names = distributed_backend.translate_model_parameter_name_for_node(p_name)
                 params += [param_name_mapping[p_name] for p_name in translated_p_names]
             g['params'] = params
-            optimized_params_cnt += sum([p.numel() for p in g['params']])
 
-        if i == 0:
+        if i == 0:  # all the clients share the same architecture
+            optimized_params_cnt = sum([p.numel() for g in client_group_specs for p in g['params']])
             print('number of optimized parameters: %.2fM' % (optimized_params_cnt / 1e6,))
 
-        if args.opt == 'adamw':
-            use_fused = (device_type == 'cuda') and ('fused' in inspect.signature(torch.optim.AdamW).parameters)
-            print(f'using fused AdamW: {use_fused}')
-            extra_args = dict(fused=True) if use_fused else dict()
-            opt = torch.optim.AdamW(group_specs, lr=args.lr, betas=(args.beta1, args.beta2),
-                                    weight_decay=args.weight_decay, **extra_args)
-        else:
-            opt = torch.optim.SGD(group_specs, lr=args.lr, momentum=0.9, weight_decay=args.weight_decay)
-
-        if args.scheduler != 'none':
-            if args.scheduler in ['cos', 'linear']:
-                scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer=opt, max_lr=args.lr,
-                                                                total_steps=args.iterations,
-                                                                pct_start=args.warmup_percent,
-                                                                anneal_strategy=args.scheduler,
-                                                                cycle_momentum=False, div_factor=1e2,
-                                                                final_div_factor=.05)
-            else:
-                raise NotImplementedError(f'Unknown scheduler type: {args.scheduler}.')
+        models.append(model)
+        group_specs += client_group_specs
+
+    # a single optimizer over the parameter groups of all clients, so that one step updates every client at once
+    if args.opt == 'adamw':
+        # with many tiny LoRA tensors the multi-tensor (foreach) kernels batch launches better than the fused one
+        n_tensors = sum(p.requires_grad for g in group_specs for p in g['params'])  # frozen weights are not updated
+        use_fused = (device_type == 'cuda') and _ADAMW_HAS_FUSED and n_tensors < _FUSED_ADAMW_MAX_TENSORS
+        print(f'using fused AdamW: {use_fused}')
+        extra_args = dict(fused=True) if use_fused else dict(foreach=True)
+        opt = torch.optim.AdamW(group_specs, lr=args.lr, betas=(args.beta1, args.beta2),
+                                weight_decay=args.weight_decay, **extra_args)
+    elif args.opt == 'adamw8bit':
+        import bitsandbytes as bnb  # only needed for 8-bit optimizer states
+        # by default tensors below 4096 elements keep 32-bit states, which would be most of the LoRA adapters
+        opt = bnb.optim.AdamW8bit(group_specs, lr=args.lr, betas=(args.beta1, args.beta2),
+                                  weight_decay=args.weight_decay, optim_bits=8, block_wise=True, min_8bit_size=0)
+    elif args.opt == 'flashadamw':
+        from flashoptim import FlashAdamW  # optional dependency, only needed for bf16 LoRA weights
+        opt = FlashAdamW(group_specs, lr=args.lr, betas=(args.beta1, args.beta2), weight_decay=args.weight_decay)
+    else:
+        opt = torch.optim.SGD(group_specs, lr=args.lr, momentum=0.9, weight_decay=args.weight_decay)
+
+    if args.scheduler != 'none':
+        if args.scheduler in ['cos', 'linear']:
+            scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer=opt, max_lr=args.lr,
+                                                            total_steps=args.iterations,
+                                                            pct_start=args.warmup_percent,
+                                                            anneal_strategy=args.scheduler,
+                                                            cycle_momentum=False, div_factor=1e2,
+                                                            final_div_factor=.05)
         else:
-            scheduler = None
+            raise NotImplementedError(f'Unknown scheduler type: {args.scheduler}.')
+    else:
+        scheduler = None
 
-        clients.append([model, opt, scheduler])
+    clients = [[model, opt, scheduler] for model in models]
 
     args.world_size = distributed_backend.get_world_size()
     exp_name = get_exp_name(args)
     if distributed_backend.is_master_process() and args.wandb:
-        params_copy = copy.deepcopy(vars(args))
-        del params_copy['device']
+        # only plain values are logged, no need to deep copy the namespace (device, dtype, ...)
+        params_copy = {k: v for k, v in vars(args).items()
+                       if k != 'device' and isinstance(v, (int, float, str, bool, list, dict, type(None)))}
         print("initialize wandb:")
         wandb.init(project=args.wandb_project, entity='ec-llm', name=get_exp_name(args), config=params_copy)
 
@@ -17,6 +17,7 @@ import tiktoken
 import torch
 import torch.nn as nn
 from torch import Tensor
+from torch.func import functional_call
 from torch.nn import functional as F
 from torch.nn.modules.module import T
 from transformers import GPT2LMHeadModel
@@ -40,6 +41,12 @@ def lora_model(model: nn.Module, lora_freeze_all_non_lora: bool, lora_allow_embe
                         param.requires_grad = True
 
 
+def get_lora_parameters(model: nn.Module) -> Dict[str, nn.Parameter]:
+    """ Return the adapters of the LoRA layers of the model (not their linear weights), keyed by their full name """
+    return {f'{mn}.{pn}': p for mn, m in model.named_modules() if isinstance(m, (LoRALinear, LoRALinear2))
+            for pn, p in m.named_parameters(recurse=False) if pn != 'weight' and pn != 'bias'}
+
+
 class LoRALinear2(nn.Linear):
 
     def __init__(self, in_features: int, out_features: int,
@@ -78,8 +85,13 @@ class LoRALinear2(nn.Linear):
     def forward(self, input: Tensor) -> Tensor:
         x = super().forward(input)
         if not self.lora_merged and self.lora_rank > 0:
-            x += self.lora_dropout(input) @ (0.5 *(self.lora_A1 @ \
-                 self.lora_B1 + self.lora_A2 @ self.lora_B2)) * self.lora_scaling
+            # low-rank products only, instead of materializing the (in, out) update of both adapters
+            input = self.lora_dropout(input)
+            if self.lora_A1.dim() == 3:
+                # adapters of several clients stacked along the first dim, see LoRALinear.forward
+                input = input.view(self.lora_A1.size(0), -1, input.size(-1))
+            delta = input @ self.lora_A1 @ self.lora_B1 + input @ self.lora_A2 @ self.lora_B2
+            x += delta.view_as(x) * (0.5 * self.lora_scaling)
         return x
 
     def train(self: T, mode: bool = True) -> T:
@@ -129,8 +141,14 @@ class LoRALinear(nn.Linear):
     def forward(self, input: Tensor) -> Tensor:
         x = super().forward(input)
         if not self.lora_merged and self.lora_rank > 0:
-            x += self.lora_dropout(input) @ self.lora_A @ \
-                 self.lora_B * self.lora_scaling
+            if self.lora_A.dim() == 3:
+                # adapters of several clients stacked along the first dim (see GPTLoRAClients) and the inputs of
+                # these clients one after the other in the batch: batched matmuls apply each adapter to its inputs
+                input = self.lora_dropout(input).view(self.lora_A.size(0), -1, input.size(-1))
+                x += (input @ self.lora_A @ self.lora_B).view_as(x) * self.lora_scaling
+            else:
+                x += self.lora_dropout(input) @ self.lora_A @ \
+                     self.lora_B * self.lora_scaling
         return x
 
     def train(self: T, mode: bool = True) -> T:
@@ -333,7 +351,8 @@ class GPTLoRA(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, idx: Tensor, targets: Tensor = None, get_logits: bool = False) -> Dict[str, Tensor]:
+    def forward(self, idx: Tensor, targets: Tensor = None, get_logits: bool = False,
+                num_clients: int = None) -> Dict[str, Tensor]:
         device = idx.device
         b, t = idx.size()
         assert t <= self.config.sequence_length, f"Cannot forward sequence of length {t}, block size is only {self.config.sequence_length}"
@@ -350,7 +369,12 @@ class GPTLoRA(nn.Module):
         if targets is not None:
             # if we are given some desired targets also calculate the loss
             logits = self.lm_head(x)
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
+            if num_clients is not None:
+                # the batch holds the batches of several clients one after the other, one mean loss per client
+                loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1,
+                                       reduction='none').view(num_clients, -1).mean(dim=1)
+            else:
+                loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
         else:
             # inference-time mini-optimization: only forward the lm_head on the very last position
             logits = self.lm_head(x[:, [-1], :])  # note: using list [-1] to preserve the time dim
@@ -495,3 +519,35 @@ class GPTLoRA(nn.Module):
             self.lm_head.weight.device)
         out_idx = self.generate(idx, max_new_tokens, temperature, top_k).view(-1).to('cpu').numpy()
         return self.tokenizer.decode(out_idx)
+
+
+class GPTLoRAClients(nn.Module):
+    """
+    Trains several clients that only differ by their LoRA adapters in a single pass: the frozen base of the first
+    client runs once over the concatenated batches of all the clients, and the adapters of the clients are stacked
+    and applied with batched matmuls. The gradients flow back to the adapters of each client, so their optimizer,
+    aggregation and evaluation are unchanged.
+    """
+
+    def __init__(self, models: List[GPTLoRA]) -> None:
+        super().__init__()
+        self.base = models[0]
+        base_params = dict(self.base.named_parameters())
+        adapters = [get_lora_parameters(model) for model in models]
+        for model in models:
+            for name, p in model.named_parameters():
+                if name in adapters[0]:
+                    continue
+                if p.requires_grad:
+                    raise ValueError(f"Batched clients can only train the LoRA adapters, '{name}' is trainable.")
+                if not torch.equal(p, base_params[name]):
+                    raise ValueError(f"Batched clients must share the same frozen weights, '{name}' differs.")
+        # a plain dict, the adapters stay registered in the models of the clients only
+        self.adapters = {name: [a[name] for a in adapters] for name in adapters[0]}
+
+    def forward(self, idx: Tensor, targets: Tensor) -> Dict[str, Tensor]:
+        """ idx and targets of shape (num_clients, b, t), the loss is returned per client, shape (num_clients,) """
+        num_clients = idx.size(0)
+        stacked = {name: torch.stack(params) for name, params in self.adapters.items()}
+        return functional_call(self.base, stacked, (idx.flatten(0, 1),),
+                               dict(targets=targets.flatten(0, 1), num_clients=num_clients))
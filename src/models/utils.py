@@ -1,7 +1,9 @@
 from argparse import Namespace
-from typing import Union
+from typing import List, Union
 
-from .lora import GPTLoRA
+from torch import nn
+
+from .lora import GPTLoRA, LoRALinear, LoRALinear2
 
 
 def get_model(args: Namespace) -> Union[GPTLoRA]:
@@ -14,3 +16,27 @@ def get_model(args: Namespace) -> Union[GPTLoRA]:
         return model
     else:
         raise KeyError(f"Unknown model '{args.model}'.")
+
+
+def get_mode_dependent_modules(model: nn.Module) -> List[nn.Module]:
+    """ Return the modules whose behaviour depends on the training mode: the model with the wrappers around it
+    (torch.compile, DDP), the dropouts and the LoRA layers (which merge their weights in eval mode) """
+    modules = [model]
+    while True:
+        inner = getattr(modules[-1], '_orig_mod', None)
+        if inner is None:
+            inner = getattr(modules[-1], 'module', None)
+        if not isinstance(inner, nn.Module):
+            break
+        modules.append(inner)
+    modules += [m for m in model.modules() if isinstance(m, (nn.Dropout, LoRALinear, LoRALinear2))]
+    return modules
+
+
+def set_train_mode(modules: List[nn.Module], mode: bool) -> None:
+    """ Same as model.train(mode), but only visits the modules given by get_mode_dependent_modules """
+    for module in modules:
+        if isinstance(module, (LoRALinear, LoRALinear2)):
+            module.train(mode)
+        else:
+            module.training = mode
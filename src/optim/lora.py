@@ -12,9 +12,16 @@ from torch.optim import Optimizer
 from torch.optim.lr_scheduler import LRScheduler
 
 from .strategies import aggregate
-from .utils import eval, get_batch
+from .utils import eval_on_device, flatten_trainable_params, _EvalBuffer, _Prefetcher
 from distributed.ddp import DataParallelDistributedBackend
 from distributed.single import SingleNodeBackend
+from models.lora import GPTLoRAClients
+from models.utils import get_mode_dependent_modules, set_train_mode
+
+
+def _open_tokens(path: str) -> np.memmap:
+    """ Maps a file of uint16 tokens, the shape is given explicitly from the file size """
+    return np.memmap(path, dtype=np.uint16, mode='r', shape=(os.path.getsize(path) // np.dtype(np.uint16).itemsize,))
 
 
 def train_lora(clients: List[List[nn.Module | Optimizer | LRScheduler]], data_path: str,
@@ -40,94 +47,177 @@ def train_lora(clients: List[List[nn.Module | Optimizer | LRScheduler]], data_pa
         local_train_data_path = os.path.join(data_path, "train_{}.bin".format(i))
         local_test_data_path = os.path.join(data_path, "test_{}.bin".format(i))
         local_valid_data_path = os.path.join(data_path, "valid_{}.bin".format(i))
-        data['train'].append(np.memmap(local_train_data_path, dtype=np.uint16, mode='r'))
-        data['val'].append(np.memmap(local_test_data_path, dtype=np.uint16, mode='r'))
-        data['ref'].append(np.memmap(local_valid_data_path, dtype=np.uint16, mode='r'))
+        data['train'].append(_open_tokens(local_train_data_path))
+        data['val'].append(_open_tokens(local_test_data_path))
+        data['ref'].append(_open_tokens(local_valid_data_path))
+    train_lens = [d.shape[0] for d in data['train']]
+    if not extra_args.no_data_on_device:
+        # keep the training tokens on the device, batches are then sampled without host to device copies
+        for i in range(num_clients):
+            data['train'][i] = torch.from_numpy(np.asarray(data['train'][i], dtype=np.int32)).to(extra_args.device)
     num_substeps_per_epoch = []
     for i in range(num_clients):
-        num_substeps_per_epoch.append(len(data['train'][i]) // (batch_size * sequence_length))
+        num_substeps_per_epoch.append(train_lens[i] // (batch_size * sequence_length))
+
+    # each client's trainable parameters become views into contiguous buffers, used for aggregation
+    flat_params = [flatten_trainable_params(model) for model, _, _ in clients]
+
+    batched_model = None
+    if extra_args.batched_clients:
+        # the clients are still evaluated and aggregated one by one, only their training is batched
+        batched_model = GPTLoRAClients([model for model, _, _ in clients])
+        xs_all = torch.empty((acc_steps, num_clients, batch_size, sequence_length), dtype=torch.int64,
+                             device=extra_args.device)
+        ys_all = torch.empty_like(xs_all)
 
     if not extra_args.no_compile:
         print(f'Compiling model ...')
         for i in range(num_clients):
-            clients[i][0] = torch.compile(clients[i][0], dynamic=True)  # requires pytorch 2.0+
+            # batch and sequence lengths are fixed for the whole run, no need for dynamic shapes
+            clients[i][0] = torch.compile(clients[i][0], dynamic=False)  # requires pytorch 2.0+
+        if batched_model is not None:
+            batched_model = torch.compile(batched_model, dynamic=False)
 
     for i in range(num_clients):
         clients[i][0].train()
-
+    # toggling only these avoids walking the whole module tree at every evaluation
+    mode_modules = [get_mode_dependent_modules(model) for model, _, _ in clients]
+
+    inv_acc_steps = 1.0 / acc_steps
+    # per-client statistics stay on the device and are read back all at once when evaluating
+    train_loss_buf = torch.zeros(num_clients, device=extra_args.device)
+    val_loss_buf = torch.zeros(num_clients, device=extra_args.device)
+    val_acc_buf = torch.zeros(num_clients, device=extra_args.device)
+    eval_buffer = _EvalBuffer(12, batch_size, sequence_length, device=extra_args.device)
+    prefetcher = _Prefetcher(data['train'], sequence_length, batch_size, acc_steps, device=extra_args.device)
+    prefetcher.prefetch(0)
+
+    finish_sync = None
     t0 = time.time()
     while itr[-1] < iterations:
-        for i in range(num_clients):
-            print(f'\r{i} {itr[i]}', end='')
-            model, opt, scheduler = clients[i]
-
+        if finish_sync is not None:
+            finish_sync()
+            finish_sync = None
+        if batched_model is not None:
+            for i in range(num_clients):
+                xs, ys = prefetcher.get(i)
+                # the buffers of this client are overwritten two prefetches later, gather them before
+                xs_all[:, i].copy_(xs)
+                ys_all[:, i].copy_(ys)
+                prefetcher.prefetch((i + 1) % num_clients)
             for microstep_idx in range(acc_steps):  # gradient accumulation
-                x, y = get_batch(data['train'][i], sequence_length, batch_size, device=extra_args.device)
                 with type_ctx:
-                    with distributed_backend.get_context_for_microstep_forward(model=model, microstep_idx=microstep_idx,
-                                                                               gradient_accumulation_steps=acc_steps):
-                        outputs = model(x, targets=y)
+                    outputs = batched_model(xs_all[microstep_idx], targets=ys_all[microstep_idx])
+
+                # one loss per client, the gradient of each client only depends on its own loss
+                loss = outputs['loss'] * inv_acc_steps
+                loss.sum().backward()
+
+            train_loss_buf.copy_(loss.detach())
+        for i in range(num_clients):
+            if itr[i] % 50 == 0:
+                print(f'\r{i} {itr[i]}', end='')
+            model, opt, scheduler = clients[i]
 
-                loss = outputs['loss'] / acc_steps
-                loss.backward()
-                substep[i] += 1
+            if batched_model is not None:
+                substep[i] += acc_steps
+            else:
+                xs, ys = prefetcher.get(i)
+                # copy the batches of the next client while this one computes
+                prefetcher.prefetch((i + 1) % num_clients)
+                for microstep_idx in range(acc_steps):  # gradient accumulation
+                    x, y = xs[microstep_idx], ys[microstep_idx]
+                    with type_ctx:
+                        with distributed_backend.get_context_for_microstep_forward(
+                                model=model, microstep_idx=microstep_idx, gradient_accumulation_steps=acc_steps):
+                            outputs = model(x, targets=y)
+
+                    loss = outputs['loss'] * inv_acc_steps
+                    loss.backward()
+                    substep[i] += 1
+
+                train_loss_buf[i] = loss.detach()
 
             if extra_args.grad_clip != 0.0:
                 torch.nn.utils.clip_grad_norm_(model.parameters(), extra_args.grad_clip)
-            opt.step()
-            scheduler.step()
             itr[i] += 1
 
+        # all the clients share the same optimizer, a single step updates all of them
+        opt.step()
+        if scheduler is not None:
+            scheduler.step()
+        # release the gradients before aggregation and evaluation
+        opt.zero_grad(set_to_none=True)
+
         # aggregate models
         if itr[-1] % extra_args.trust_freq == 0 and itr[-1] >= extra_args.pretraining_rounds - 1:
-            aggregate(clients, extra_args.trust, data, sequence_length, batch_size, type_ctx, extra_args)
+            aggregate(clients, extra_args.trust, data, sequence_length, batch_size, type_ctx, flat_params,
+                      extra_args)
+            if extra_args.trust != 'none':
+                # trust weights are computed on each process' own batches, keep the replicas identical; the flat
+                # buffers are all-reduced in place and overlap with whatever runs before the weights are used again
+                finish_sync = distributed_backend.average_tensors_async(
+                    [flat for flats in flat_params for flat in flats])
 
         # from here it's only evaluation code, all the training is above
         t1 = time.time()
         dt = (t1 - t0) / num_clients
+        evaluated = []
         for i in range(num_clients):
             model, opt, scheduler = clients[i]
-            opt.zero_grad(set_to_none=True)
 
             if itr[i] % eval_freq == 0 or itr[i] == iterations:
                 if distributed_backend.is_master_process():
-                    epoch = substep[i] // num_substeps_per_epoch[i]
-
-                    model.eval()
-                    train_loss = loss.detach().cpu().item() * acc_steps
-                    current_lr = scheduler.get_last_lr()[0] if scheduler is not None else extra_args.lr
-                    val_acc, val_loss, val_perplexity = eval(model, data['val'][i], sequence_length, batch_size,
-                                                             extra_args.device, max_num_batches=12, ctx=type_ctx)
-
-                    print_string = f"{i}: {epoch}/{itr[i]} [train] loss={train_loss:.3f} [val] loss={val_loss:.3f}, pp={val_perplexity:.2f}, acc={val_acc:3f}"
-                    print_string += f" [time per itr] {dt * 1000 / eval_freq:.2f}ms"
-                    if scheduler is not None:
-                        print_string += f" [lr] {current_lr:.5f}"
-                    print(f'\r{print_string}')
-
-                    stats['train_loss'][i].append(train_loss)
-                    stats['val_loss'][i].append(val_loss)
-                    stats['val_pp'][i].append(val_perplexity)
-                    stats['val_acc'][i].append(val_acc)
-
-                    if extra_args.wandb:
-                        if i == (num_clients - 1):
-                            wandb.log({
-                                f"train/loss_mean": np.mean([stats['train_loss'][i][-1] for i in range(num_clients)]),
-                                f"val/loss_mean": np.mean([stats['val_loss'][i][-1] for i in range(num_clients)]),
-                                f"val/perplexity_mean": np.mean([stats['val_pp'][i][-1] for i in range(num_clients)]),
-                                f"val/acc_mean": np.mean([stats['val_acc'][i][-1] for i in range(num_clients)]),
-                            }, commit=False)
+                    if finish_sync is not None:
+                        finish_sync()
+                        finish_sync = None
+                    set_train_mode(mode_modules[i], False)
+                    val_acc_buf[i], val_loss_buf[i] = eval_on_device(model, data['val'][i], sequence_length,
+                                                                     batch_size, extra_args.device,
+                                                                     max_num_batches=12, ctx=type_ctx,
+                                                                     buffer=eval_buffer)
+                    set_train_mode(mode_modules[i], True)
+                    evaluated.append(i)
+
+        if len(evaluated) > 0:
+            # a single synchronization for the train and validation statistics of all the clients
+            train_losses, val_losses, val_accs = torch.stack((train_loss_buf, val_loss_buf, val_acc_buf)).tolist()
+            for i in evaluated:
+                model, opt, scheduler = clients[i]
+                epoch = substep[i] // num_substeps_per_epoch[i]
+
+                train_loss = train_losses[i] * acc_steps
+                current_lr = scheduler.get_last_lr()[0] if scheduler is not None else extra_args.lr
+                val_acc, val_loss = val_accs[i], val_losses[i]
+                val_perplexity = 2.71828 ** val_loss
+
+                print_string = f"{i}: {epoch}/{itr[i]} [train] loss={train_loss:.3f} [val] loss={val_loss:.3f}, pp={val_perplexity:.2f}, acc={val_acc:3f}"
+                print_string += f" [time per itr] {dt * 1000 / eval_freq:.2f}ms"
+                if scheduler is not None:
+                    print_string += f" [lr] {current_lr:.5f}"
+                print(f'\r{print_string}')
+
+                stats['train_loss'][i].append(train_loss)
+                stats['val_loss'][i].append(val_loss)
+                stats['val_pp'][i].append(val_perplexity)
+                stats['val_acc'][i].append(val_acc)
+
+                if extra_args.wandb:
+                    if i == (num_clients - 1):
                         wandb.log({
-                            f"iter_{i}": itr[i],
-                            f"train/loss_{i}": train_loss,
-                            f"val/loss_{i}": val_loss,
-                            f"val/perplexity_{i}": val_perplexity,
-                            f"val/acc_{i}": val_acc,
-                            f"lr_{i}": current_lr,
-                        }, commit=(i == (num_clients - 1)))
-
-                    model.train()
+                            f"train/loss_mean": np.mean([stats['train_loss'][i][-1] for i in range(num_clients)]),
+                            f"val/loss_mean": np.mean([stats['val_loss'][i][-1] for i in range(num_clients)]),
+                            f"val/perplexity_mean": np.mean([stats['val_pp'][i][-1] for i in range(num_clients)]),
+                            f"val/acc_mean": np.mean([stats['val_acc'][i][-1] for i in range(num_clients)]),
+                        }, commit=False)
+                    wandb.log({
+                        f"iter_{i}": itr[i],
+                        f"train/loss_{i}": train_loss,
+                        f"val/loss_{i}": val_loss,
+                        f"val/perplexity_{i}": val_perplexity,
+                        f"val/acc_{i}": val_acc,
+                        f"lr_{i}": current_lr,
+                    }, commit=(i == (num_clients - 1)))
         if itr[-1] % eval_freq == 0 or itr[-1] == iterations:
             for idx, c in enumerate(clients):
                 model, _, _ = c
@@ -20,7 +20,8 @@ from optim.utils import get_batch, eval
 
 def aggregate(clients: List[List[nn.Module | Optimizer | LRScheduler]], trust: str,
               data: Dict[str, List[np.ndarray] | np.ndarray], sequence_length: int, batch_size: int,
-              type_ctx: Union[nullcontext, autocast], extra_args: Namespace) -> None:
+              type_ctx: Union[nullcontext, autocast], flat_params: List[List[Tensor]],
+              extra_args: Namespace) -> None:
     trust_weights = None
     if trust == 'none':
         return
@@ -55,7 +56,7 @@ def aggregate(clients: List[List[nn.Module | Optimizer | LRScheduler]], trust: s
         elif trust == 'dynamic-top-k-token':
             trust_weights = __top_k(trust_weights, extra_args.k)
 
-    __weighted_average(clients, trust_weights, extra_args)
+    __weighted_average(trust_weights, flat_params, extra_args)
 
 
 def __threshold(tensor: Tensor, threshold: float) -> Tensor:
@@ -73,32 +74,18 @@ def __top_k(tensor: Tensor, top_k: int) -> Tensor:
     return F.softmax(mask, dim=1)
 
 
-def __weighted_average(clients: List[List[nn.Module | Optimizer | LRScheduler]], trust_weights: Tensor,
-                       extra_args: Namespace) -> None:
+def __weighted_average(trust_weights: Tensor, flat_params: List[List[Tensor]], extra_args: Namespace) -> None:
     if extra_args.wandb:
         wandb.log({'Trust weights': json.dumps(np.array(trust_weights).tolist())}, commit=False)
 
-    weights = {}
-    for id, client in enumerate(clients):
-        for name, param in client[0].named_parameters():
-            if param.requires_grad:
-                if name in weights:
-                    weights[name][id] = param.data.clone()
-                else:
-                    weights[name] = {}
-                    weights[name][id] = param.data.clone()
-
-    for idx, client in enumerate(clients):
-        model, _, _ = client
-
-        for name, param in model.named_parameters():
-            if param.requires_grad:
-                val = torch.zeros_like(param)
-                for i in range(len(clients)):
-                    val += trust_weights[idx, i] * weights[name][i]
-                param.data = val
-
-    del weights
+    # the trainable parameters of each client are views into a few flat buffers (see flatten_trainable_params),
+    # the weighted average of all the clients is a single matmul per buffer
+    for bucket in range(len(flat_params[0])):
+        stacked = torch.stack([flats[bucket] for flats in flat_params])
+        averaged = trust_weights.to(device=stacked.device, dtype=stacked.dtype) @ stacked
+        for flats, val in zip(flat_params, averaged):
+            # update in place: swapping the tensor would invalidate the guards of the compiled model
+            flats[bucket].copy_(val)
 
 
 def __naive_weights(clients: List[List[nn.Module | Optimizer | LRScheduler]]) -> Tensor:
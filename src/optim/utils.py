@@ -1,9 +1,10 @@
 from contextlib import nullcontext
-from typing import Tuple, Union
+from typing import List, Tuple, Union
 
 import numpy as np
 import torch
 from torch import Tensor, nn
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 from torch.cuda.amp import autocast
 
 
@@ -18,23 +19,166 @@ def get_batch(data: np.ndarray, seq_length: int, batch_size: int, device: str =
     return x, y
 
 
+def flatten_trainable_params(model: nn.Module) -> List[Tensor]:
+    """
+    Moves the trainable parameters of the model into one contiguous buffer per dtype and turns them into views of
+    it, so that aggregation and communication work on a few large tensors instead of many small ones.
+    """
+    buckets = {}
+    for p in model.parameters():
+        if p.requires_grad:
+            buckets.setdefault(p.dtype, []).append(p)
+
+    flat_params = []
+    for params in buckets.values():
+        flat = _flatten_dense_tensors([p.data for p in params])
+        for p, view in zip(params, _unflatten_dense_tensors(flat, params)):
+            p.data = view
+        flat_params.append(flat)
+    return flat_params
+
+
+def _stage_windows(out: np.ndarray, data: np.ndarray, ix: Tensor, seq_length: int) -> None:
+    """ Writes the input and target windows starting at ix into out, of shape (2, ..., seq_length) """
+    windows = np.stack([data[i:i + seq_length + 1] for i in ix.tolist()])
+    windows = windows.reshape(*out.shape[1:-1], seq_length + 1)
+    np.copyto(out[0], windows[..., :-1], casting='unsafe')
+    np.copyto(out[1], windows[..., 1:], casting='unsafe')
+
+
+class _Prefetcher(object):
+    """
+    Samples all the microstep batches of a client at once, stages them in pinned memory and copies them to the device
+    on a side stream. The batches of the next client are copied while the current client computes (double-buffered).
+    """
+
+    def __init__(self, data: List[np.ndarray | Tensor], seq_length: int, batch_size: int, acc_steps: int,
+                 device: str = 'cpu') -> None:
+        self.data = data
+        self.lens = [len(d) for d in data]
+        self.seq_length = seq_length
+        self.batch_size = batch_size
+        self.acc_steps = acc_steps
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == 'cuda'
+
+        # x and y are staged separately so that both are contiguous on the device
+        shape = (2, acc_steps, batch_size, seq_length)
+        self.buffers = [torch.empty(shape, dtype=torch.int64, device=self.device) for _ in range(2)]
+        self.events = [None, None]
+        self.clients = [None, None]
+        self.slot = 0
+        # the pinned staging buffers and the copy stream are only needed for tokens kept on the host
+        self.host, self.stream = None, None
+        if any(not isinstance(d, Tensor) for d in data):
+            self.host = [torch.empty(shape, dtype=torch.int64, pin_memory=self.use_cuda) for _ in range(2)]
+            self.stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+
+    def prefetch(self, client: int) -> None:
+        self.slot = 1 - self.slot
+        slot = self.slot
+        if self.events[slot] is not None:
+            # the previous copy out of this host buffer must be done before overwriting it
+            self.events[slot].synchronize()
+
+        data = self.data[client]
+        if isinstance(data, Tensor):
+            # the tokens are already resident on the device, gather the windows there without any copy from the host
+            ix = torch.randint(self.lens[client] - self.seq_length, (self.acc_steps * self.batch_size,),
+                               device=data.device)
+            offsets = ix[:, None] + torch.arange(self.seq_length + 1, device=data.device)[None, :]
+            windows = data[offsets].view(self.acc_steps, self.batch_size, self.seq_length + 1)
+            self.buffers[slot][0].copy_(windows[..., :-1])
+            self.buffers[slot][1].copy_(windows[..., 1:])
+            self.events[slot] = None
+            self.clients[slot] = client
+            return
+
+        ix = torch.randint(self.lens[client] - self.seq_length, (self.acc_steps * self.batch_size,))
+        _stage_windows(self.host[slot].numpy(), data, ix, self.seq_length)
+
+        if self.use_cuda:
+            # the device buffer may still be read by the compute stream (client before the current one)
+            self.stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(self.stream):
+                self.buffers[slot].copy_(self.host[slot], non_blocking=True)
+            self.events[slot] = self.stream.record_event()
+        else:
+            self.buffers[slot].copy_(self.host[slot])
+        self.clients[slot] = client
+
+    def get(self, client: int) -> Tuple[Tensor, Tensor]:
+        """ Returns x, y of shape (acc_steps, batch_size, seq_length) for the given (already prefetched) client """
+        slot = self.clients.index(client)
+        self.clients[slot] = None
+        if self.events[slot] is not None:
+            torch.cuda.current_stream(self.device).wait_event(self.events[slot])
+        return self.buffers[slot][0], self.buffers[slot][1]
+
+
+class _EvalBuffer(object):
+    """ Pinned host buffer for the evaluation batches, allocated once and reused across eval calls """
+
+    def __init__(self, max_num_batches: int, batch_size: int, seq_length: int, device: str = 'cpu') -> None:
+        self.max_num_batches = max_num_batches
+        self.batch_size = batch_size
+        self.seq_length = seq_length
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == 'cuda'
+        self.host = torch.empty((2, max_num_batches, batch_size, seq_length), dtype=torch.int32,
+                                pin_memory=self.use_cuda)
+        self.event = None
+
+    def load(self, data: np.ndarray) -> Tensor:
+        """ Returns x, y of all the batches on the device, shape (2, max_num_batches, batch_size, seq_length) """
+        if self.event is not None:
+            # the previous copy out of the buffer must be done before overwriting it
+            self.event.synchronize()
+        ix = torch.randint(len(data) - self.seq_length, (self.max_num_batches * self.batch_size,))
+        _stage_windows(self.host.numpy(), data, ix, self.seq_length)
+        batches = self.host.to(self.device, non_blocking=True)
+        if self.use_cuda:
+            self.event = torch.cuda.Event()
+            self.event.record()
+        return batches.long()
+
+
 @torch.no_grad()
-def eval(model: nn.Module, data_tensor: np.ndarray, sequence_length: int, batch_size: int, device: str = 'cpu',
-         max_num_batches: int = 24, ctx: Union[nullcontext, autocast] = nullcontext()) -> Tuple[float, float, float]:
+def eval_on_device(model: nn.Module, data_tensor: np.ndarray, sequence_length: int, batch_size: int,
+                   device: str = 'cpu', max_num_batches: int = 24,
+                   ctx: Union[nullcontext, autocast] = nullcontext(),
+                   buffer: _EvalBuffer = None) -> Tuple[Tensor, Tensor]:
+    """ Same as eval, but returns the accuracy and loss as device tensors without synchronizing """
     assert model.training == False
 
     loss_list_val, acc_list = [], []
 
-    for _ in range(max_num_batches):
-        x, y = get_batch(data_tensor, sequence_length, batch_size, device=device)
+    if buffer is not None:
+        assert buffer.max_num_batches == max_num_batches
+        batches = buffer.load(data_tensor)
+
+    for k in range(max_num_batches):
+        if buffer is not None:
+            x, y = batches[0, k], batches[1, k]
+        else:
+            x, y = get_batch(data_tensor, sequence_length, batch_size, device=device)
         with ctx:
             outputs = model(x, targets=y, get_logits=True)
         val_loss = outputs['loss']
         loss_list_val.append(val_loss)
         acc_list.append((outputs['logits'].argmax(-1) == y).float().mean())
 
-    val_acc = torch.stack(acc_list).mean().item()
-    val_loss = torch.stack(loss_list_val).mean().item()
+    return torch.stack(acc_list).mean(), torch.stack(loss_list_val).mean()
+
+
+@torch.no_grad()
+def eval(model: nn.Module, data_tensor: np.ndarray, sequence_length: int, batch_size: int, device: str = 'cpu',
+         max_num_batches: int = 24, ctx: Union[nullcontext, autocast] = nullcontext()) -> Tuple[float, float, float]:
+    val_acc, val_loss = eval_on_device(model, data_tensor, sequence_length, batch_size, device=device,
+                                       max_num_batches=max_num_batches, ctx=ctx)
+
+    val_acc = val_acc.item()
+    val_loss = val_loss.item()
     val_perplexity = 2.71828 ** val_loss
 
     return val_acc, val_loss, val_perplexity